@@ -7,67 +7,110 @@ from treefmt.toml, filtering out linters and tools that don't support stdin.
 
 from __future__ import annotations
 
+import functools
 import hashlib
+import mmap
 import os
 import re
 import subprocess
 import sys
+import tomllib
 from pathlib import Path
 
 # Tools completely excluded from jj fix
 # mypy: type checker that doesn't modify files, treefmt generates complex bash scripts
-EXCLUDED_TOOLS = {"mypy"}
+EXCLUDED_TOOLS = frozenset({"mypy"})
 
 # Linters: show warnings via pass-through (stderr), pass content unchanged (stdout)
-PASSTHROUGH_LINTERS = {
-    "shellcheck",
-    "statix",
-}
+PASSTHROUGH_LINTERS = frozenset(
+    {
+        "shellcheck",
+        "statix",
+    }
+)
 
 # Tools that need special stdin arguments
 STDIN_ARGS = {
-    "yamlfmt": ["-"],
-    "keep-sorted": ["-"],
-    "tofu": ["-"],  # tofu fmt -
-    "terraform": ["-"],  # terraform fmt -
-    "prettier": ["--stdin-filepath=$path"],
-    "taplo": ["-"],  # taplo format -
-    "ruff": ["--stdin-filename=$path"],  # ruff format/check needs filename for stdin
-    "mdformat": ["-"],  # mdformat reads from stdin with -
-    "shfmt": ["-"],  # shfmt reads from stdin with -
-    "typstyle": [],  # typstyle reads from stdin by default (no arg needed)
+    "yamlfmt": ("-",),
+    "keep-sorted": ("-",),
+    "tofu": ("-",),  # tofu fmt -
+    "terraform": ("-",),  # terraform fmt -
+    "prettier": ("--stdin-filepath=$path",),
+    "taplo": ("-",),  # taplo format -
+    "ruff": ("--stdin-filename=$path",),  # ruff format/check needs filename for stdin
+    "mdformat": ("-",),  # mdformat reads from stdin with -
+    "shfmt": ("-",),  # shfmt reads from stdin with -
+    "typstyle": (),  # typstyle reads from stdin by default (no arg needed)
 }
 
 # Tool-specific stdin args (keyed by tool name, takes precedence over STDIN_ARGS)
 # ruff check --fix-only outputs fixed content to stdout (unlike --fix which is in-place)
 TOOL_STDIN_ARGS = {
-    "ruff-check": ["--fix-only", "--stdin-filename=$path", "-"],
-    "ruff-isort": ["--fix-only", "--stdin-filename=$path", "-"],
+    "ruff-check": ("--fix-only", "--stdin-filename=$path", "-"),
+    "ruff-isort": ("--fix-only", "--stdin-filename=$path", "-"),
 }
 
 # Tools that need wrapper scripts (no stdin support, but do modify files)
-NEEDS_WRAPPER = {
-    "deadnix",  # Requires file path, uses --edit
-}
+NEEDS_WRAPPER = frozenset(
+    {
+        "deadnix",  # Requires file path, uses --edit
+    }
+)
 
 # Tools where -i means inplace (not indent)
-INPLACE_SHORT_FLAG = {
-    "typstyle",  # -i = --inplace
-}
+INPLACE_SHORT_FLAG = frozenset(
+    {
+        "typstyle",  # -i = --inplace
+    }
+)
+
+# Wrapper type per tool (wrappers take precedence over linters)
+_WRAPPER_TYPE = dict.fromkeys(PASSTHROUGH_LINTERS, "passthrough") | dict.fromkeys(
+    NEEDS_WRAPPER, "edit"
+)
+
+# Escape backslashes, double quotes, and newlines for TOML basic strings
+_TOML_ESCAPE = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n"})
+
+# treefmt config path embedded in the formatter wrapper script
+_CONFIG_FILE_RE = re.compile(rb"--config-file=(\S+)")
+
+# Start of the first non-jmt section after the generated block
+_JJ_SECTION_RE = re.compile(r"\n\[(?!fix\.tools\.)")
+
+
+# Pending stderr messages, written out in one go by flush_log()
+_STDERR_BUF: list[str] = []
+
+
+def log(msg: str) -> None:
+    _STDERR_BUF.append(msg + "\n")
+
+
+def flush_log() -> None:
+    if _STDERR_BUF:
+        sys.stderr.write("".join(_STDERR_BUF))
+        sys.stderr.flush()
+        _STDERR_BUF.clear()
 
 
 def debug(msg: str) -> None:
     if os.environ.get("JMT_DEBUG"):
-        print(f"[debug] {msg}", file=sys.stderr)
+        # Write immediately (after pending messages) so debug output shows hangs
+        log(f"[debug] {msg}")
+        flush_log()
 
 
 def find_flake_root() -> Path | None:
     """Find the nearest flake.nix by walking up."""
-    cwd = Path.cwd()
-    for parent in [cwd, *cwd.parents]:
-        if (parent / "flake.nix").exists():
-            return parent
-    return None
+    cwd = os.getcwd()
+    while True:
+        if os.path.isfile(os.path.join(cwd, "flake.nix")):
+            return Path(cwd)
+        parent = os.path.dirname(cwd)
+        if parent == cwd:
+            return None
+        cwd = parent
 
 
 def get_cache_dir() -> Path:
@@ -86,49 +129,98 @@ def get_cache_path(flake_root: Path) -> Path:
     return get_cache_dir() / key
 
 
+def get_lock_hash_path(cache_path: Path) -> Path:
+    """Get path of the flake.lock hash stored alongside the cached formatter."""
+    return cache_path.parent / f"{cache_path.name}.lock.sha"
+
+
+def hash_flake_lock(flake_root: Path) -> str:
+    """Hash flake.lock contents (empty string if the flake has no lock file)."""
+    try:
+        data = (flake_root / "flake.lock").read_bytes()
+    except FileNotFoundError:
+        return ""
+    return hashlib.sha256(data).hexdigest()
+
+
 def needs_rebuild(flake_root: Path, cache_path: Path) -> bool:
     """Check if formatter needs to be rebuilt."""
     if os.environ.get("NO_CACHE"):
         debug("NO_CACHE set, forcing rebuild")
         return True
 
-    if not cache_path.exists():
+    # Use lstat() to get symlink's own mtime (not the target in nix store)
+    try:
+        cache_mtime = cache_path.lstat().st_mtime
+    except FileNotFoundError:
         debug("Cache doesn't exist")
         return True
 
-    # Use lstat() to get symlink's own mtime (not the target in nix store)
-    cache_mtime = cache_path.lstat().st_mtime
-
-    # Check flake files
-    for filename in ["flake.nix", "flake.lock"]:
-        file_path = flake_root / filename
-        if file_path.exists():
-            file_mtime = file_path.stat().st_mtime
-            if file_mtime > cache_mtime:
-                debug(f"{filename} is newer than cache")
-                return True
-
-    # Check formatter directory (flake-module.nix etc.)
-    formatter_dir = flake_root / "formatter"
-    if formatter_dir.exists():
-        for file_path in formatter_dir.glob("*.nix"):
-            file_mtime = file_path.stat().st_mtime
-            if file_mtime > cache_mtime:
-                debug(f"{file_path.name} is newer than cache")
-                return True
+    # Check flake.nix and formatter directory (flake-module.nix etc.) in one pass
+    formatter_dir = None
+    with os.scandir(flake_root) as it:
+        for entry in it:
+            if entry.name == "flake.nix":
+                if entry.stat().st_mtime > cache_mtime:
+                    debug(f"{entry.name} is newer than cache")
+                    return True
+            elif entry.name == "formatter" and entry.is_dir():
+                formatter_dir = entry.path
+
+    # The directory's own mtime can't be used to skip this scan: it only changes
+    # when entries are added/removed/renamed, not when a file is edited in place.
+    if formatter_dir is not None:
+        with os.scandir(formatter_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".nix") and entry.stat().st_mtime > cache_mtime:
+                    debug(f"{entry.name} is newer than cache")
+                    return True
+
+    # Compare flake.lock by content, so touching it (checkout, no-op update) is free
+    try:
+        cached_hash = get_lock_hash_path(cache_path).read_text()
+    except FileNotFoundError:
+        debug("flake.lock hash not cached")
+        return True
+    if cached_hash != hash_flake_lock(flake_root):
+        debug("flake.lock changed since last build")
+        return True
 
     debug("Cache is valid")
     return False
 
 
 def get_system() -> str:
-    """Get current Nix system."""
-    result = subprocess.run(
-        ["nix", "eval", "--raw", "--impure", "--expr", "builtins.currentSystem"],
-        capture_output=True,
-        text=True,
-    )
-    return result.stdout.strip() or "x86_64-linux"
+    """Get current Nix system (cached, since it never changes for a host)."""
+    # Allow overriding the system (e.g. for cross or remote setups)
+    override = os.environ.get("JMT_SYSTEM")
+    if override:
+        return override
+
+    system_cache = get_cache_dir() / "system"
+    try:
+        cached = system_cache.read_text().strip()
+    except FileNotFoundError:
+        cached = ""
+    if cached:
+        debug(f"Using cached system: {cached}")
+        return cached
+
+    try:
+        system = subprocess.check_output(
+            ["nix", "eval", "--raw", "--impure", "--expr", "builtins.currentSystem"],
+            text=True,
+            stdin=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        system = ""
+    if not system:
+        return "x86_64-linux"
+
+    system_cache.parent.mkdir(parents=True, exist_ok=True)
+    system_cache.write_text(system)
+    return system
 
 
 def build_formatter(flake_root: Path, cache_path: Path) -> Path | None:
@@ -138,55 +230,67 @@ def build_formatter(flake_root: Path, cache_path: Path) -> Path | None:
 
     cache_path.parent.mkdir(parents=True, exist_ok=True)
 
-    print(f"Building formatter for {system}...", file=sys.stderr)
+    log(f"Building formatter for {system}...")
+    flush_log()
     result = subprocess.run(
         ["nix", "build", attr, "--out-link", str(cache_path)],
         cwd=flake_root,
     )
 
     if result.returncode != 0:
-        print("Failed to build formatter", file=sys.stderr)
+        log("Failed to build formatter")
         return None
 
+    get_lock_hash_path(cache_path).write_text(hash_flake_lock(flake_root))
     return cache_path
 
 
 def find_treefmt_config(formatter_path: Path) -> Path | None:
     """Extract treefmt.toml path from wrapper script."""
-    wrapper = formatter_path / "bin" / "treefmt"
-    if not wrapper.exists():
+    bin_dir = formatter_path / "bin"
+    wrapper = bin_dir / "treefmt"
+    try:
+        f = wrapper.open("rb")
+    except FileNotFoundError:
         # Try finding any executable
-        bin_dir = formatter_path / "bin"
-        if bin_dir.exists():
-            for f in bin_dir.iterdir():
-                if f.is_file():
-                    wrapper = f
-                    break
-
-    if not wrapper.exists():
-        return None
-
-    content = wrapper.read_text()
-
-    # Look for --config-file= pattern
-    match = re.search(r"--config-file=([^\s]+)", content)
-    if match:
-        return Path(match.group(1))
+        fallback = None
+        try:
+            with os.scandir(bin_dir) as it:
+                for entry in it:
+                    if entry.is_file():
+                        fallback = Path(entry.path)
+                        break
+        except FileNotFoundError:
+            pass
+
+        if fallback is None:
+            return None
+
+        f = fallback.open("rb")
+
+    with f:
+        # Empty files can't be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        # Search the mapped file directly instead of reading it into memory
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Look for --config-file= pattern
+            match = _CONFIG_FILE_RE.search(mm)
+            config_file = match.group(1) if match else None
+
+    if config_file:
+        return Path(os.fsdecode(config_file))
 
     return None
 
 
 def parse_treefmt_config(config_path: Path) -> dict:
     """Parse treefmt.toml and extract formatter info."""
-    try:
-        import tomllib
-    except ImportError:
-        import tomli as tomllib  # type: ignore[import-not-found,no-redef]
-
-    content = config_path.read_text()
-    return tomllib.loads(content)
+    with config_path.open("rb") as f:
+        return tomllib.load(f)
 
 
+@functools.lru_cache(maxsize=512)
 def glob_to_jj_pattern(pattern: str) -> str:
     """Convert treefmt include pattern to jj fix glob pattern."""
     # treefmt uses simple globs like "*.nix", jj fix needs "glob:'**/*.nix'"
@@ -198,6 +302,18 @@ def glob_to_jj_pattern(pattern: str) -> str:
         return f"glob:'{pattern}'"
 
 
+def get_wrapper_type(name: str) -> str | None:
+    """Get wrapper type for a tool: None, "edit", or "passthrough".
+
+    Tool-directory names like "statix-foo" match their "statix" prefix.
+    """
+    while True:
+        wrapper_type = _WRAPPER_TYPE.get(name)
+        if wrapper_type is not None or "-" not in name:
+            return wrapper_type
+        name = name.rpartition("-")[0]
+
+
 def get_inline_command(name: str, command: str, options: list[str], mode: str) -> list[str]:
     """Generate inline bash -c command for tools that need wrapping.
 
@@ -239,7 +355,7 @@ def get_stdin_command(
 
     wrapper_type: None, "edit", or "passthrough"
     """
-    cmd_name = Path(command).name
+    cmd_name = command.rpartition("/")[2]
 
     # Use inline bash for tools that need wrapping
     if wrapper_type == "edit":
@@ -259,27 +375,25 @@ def get_stdin_command(
     # Tool-specific stdin args (by tool name, takes precedence)
     for tool, args in TOOL_STDIN_ARGS.items():
         if name == tool or name.startswith(f"{tool}-"):
-            return [*base_cmd, *args]
+            base_cmd.extend(args)
+            return base_cmd
 
     # Add stdin argument if needed
-    if cmd_name in STDIN_ARGS:
-        return [*base_cmd, *STDIN_ARGS[cmd_name]]
+    tail = STDIN_ARGS.get(cmd_name)
+    if tail is not None:
+        base_cmd.extend(tail)
+        return base_cmd
 
     # Special case for terraform/tofu fmt
     if "fmt" in filtered_opts and cmd_name in ("tofu", "terraform"):
-        return [*base_cmd, "-"]
+        base_cmd.append("-")
 
     return base_cmd
 
 
 def to_toml_array(items: list[str]) -> str:
     """Convert list to TOML array format."""
-    escaped = []
-    for item in items:
-        # Escape backslashes, double quotes, and newlines for TOML
-        item = item.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
-        escaped.append(f'"{item}"')
-    return "[" + ", ".join(escaped) + "]"
+    return "[" + ", ".join(f'"{item.translate(_TOML_ESCAPE)}"' for item in items) + "]"
 
 
 def generate_jj_config(treefmt_config: dict, only_tools: set[str] | None = None) -> str:
@@ -289,7 +403,9 @@ def generate_jj_config(treefmt_config: dict, only_tools: set[str] | None = None)
     formatters = treefmt_config.get("formatter", {})
     global_excludes = treefmt_config.get("global", {}).get("excludes", [])
 
-    for name, config in sorted(formatters.items()):
+    # Filter before sorting so --only doesn't sort every formatter
+    selected = []
+    for name, config in formatters.items():
         # Check exclusion with prefix matching (e.g., "mypy-foo" matches "mypy")
         excluded = any(name == tool or name.startswith(f"{tool}-") for tool in EXCLUDED_TOOLS)
         if excluded:
@@ -298,7 +414,10 @@ def generate_jj_config(treefmt_config: dict, only_tools: set[str] | None = None)
         if only_tools is not None and name not in only_tools:
             debug(f"Skipping tool (not in --only): {name}")
             continue
+        selected.append((name, config))
+    selected.sort(key=lambda item: item[0])
 
+    for name, config in selected:
         command = config.get("command", "")
         if not command:
             continue
@@ -310,31 +429,15 @@ def generate_jj_config(treefmt_config: dict, only_tools: set[str] | None = None)
         options = config.get("options", [])
         excludes = config.get("excludes", [])
 
-        # Determine wrapper type (use prefix matching for tool-directory names)
-        wrapper_type = None
-        for tool in NEEDS_WRAPPER:
-            if name == tool or name.startswith(f"{tool}-"):
-                wrapper_type = "edit"
-                break
-        if wrapper_type is None:
-            for tool in PASSTHROUGH_LINTERS:
-                if name == tool or name.startswith(f"{tool}-"):
-                    wrapper_type = "passthrough"
-                    break
-
-        cmd = get_stdin_command(name, command, options, wrapper_type=wrapper_type)
-
-        # Convert patterns with excludes
-        patterns = []
-        for inc in includes:
-            base_pattern = glob_to_jj_pattern(inc)
-            # Apply excludes using fileset difference operator
-            all_excludes = excludes + global_excludes
-            if all_excludes:
-                exclude_patterns = " ~ ".join(glob_to_jj_pattern(e) for e in all_excludes)
-                patterns.append(f"({base_pattern} ~ {exclude_patterns})")
-            else:
-                patterns.append(base_pattern)
+        cmd = get_stdin_command(name, command, options, wrapper_type=get_wrapper_type(name))
+
+        # Convert patterns with excludes (applied using fileset difference operator)
+        all_excludes = excludes + global_excludes
+        if all_excludes:
+            exclude_patterns = " ~ ".join(glob_to_jj_pattern(e) for e in all_excludes)
+            patterns = [f"({glob_to_jj_pattern(inc)} ~ {exclude_patterns})" for inc in includes]
+        else:
+            patterns = [glob_to_jj_pattern(inc) for inc in includes]
 
         lines.append(f"[fix.tools.{name}]")
         lines.append(f"command = {to_toml_array(cmd)}")
@@ -367,41 +470,43 @@ def write_jj_config(config: str, flake_root: Path) -> bool:
     """Write config to jj's repo-level config file."""
     jj_config = get_jj_config_path(flake_root)
     if not jj_config:
-        print(f"Not a jj repository: {flake_root}", file=sys.stderr)
+        log(f"Not a jj repository: {flake_root}")
         return False
 
     # Ensure parent directory exists
     jj_config.parent.mkdir(parents=True, exist_ok=True)
 
     # Read existing config if any
-    existing = ""
-    if jj_config.exists():
-        existing = jj_config.read_text()
+    try:
+        current = jj_config.read_text()
+    except FileNotFoundError:
+        current = ""
 
     # Remove old generated section
-    marker = "# Generated by jmt"
-    if marker in existing:
-        start_idx = existing.index(marker)
-        rest = existing[start_idx:]
-        end_match = re.search(r"\n\[(?!fix\.tools\.)", rest)
-        if end_match:
-            end_idx = start_idx + end_match.start()
-            existing = existing[:start_idx] + existing[end_idx:]
-        else:
-            existing = existing[:start_idx]
+    existing = current
+    head, marker, rest = existing.partition("# Generated by jmt")
+    if marker:
+        end_match = _JJ_SECTION_RE.search(rest)
+        existing = head + rest[end_match.start() :] if end_match else head
 
     # Append new config
     new_content = existing.rstrip() + "\n\n" + config if existing.strip() else config
 
+    # Leave the file (and its mtime) alone if nothing changed
+    if new_content == current:
+        log(f"Unchanged: {jj_config}")
+        return True
+
     jj_config.write_text(new_content)
-    print(f"Written to {jj_config}", file=sys.stderr)
+    log(f"Written to {jj_config}")
     return True
 
 
 def run_jj_fix(flake_root: Path, extra_args: list[str] | None = None) -> int:
     """Run jj fix with optional extra arguments."""
     cmd = ["jj", "fix", "--include-unchanged-files"] + (extra_args or [])
-    print(f"Running {' '.join(cmd)}...", file=sys.stderr)
+    log(f"Running {' '.join(cmd)}...")
+    flush_log()
     result = subprocess.run(cmd, cwd=flake_root)
     return result.returncode
 
@@ -420,11 +525,10 @@ def list_tools(treefmt_config: dict) -> None:
         if len(includes) > 3:
             patterns += f", ... (+{len(includes) - 3})"
         status = ""
-        is_linter = any(name == tool or name.startswith(f"{tool}-") for tool in PASSTHROUGH_LINTERS)
-        is_wrapper = any(name == tool or name.startswith(f"{tool}-") for tool in NEEDS_WRAPPER)
-        if is_linter:
+        wrapper_type = get_wrapper_type(name)
+        if wrapper_type == "passthrough":
             status = " [linter]"
-        elif is_wrapper:
+        elif wrapper_type == "edit":
             status = " [wrapper]"
         print(f"  {name}{status}: {patterns}")
 
@@ -432,31 +536,34 @@ def list_tools(treefmt_config: dict) -> None:
 def parse_args() -> tuple[list[str], list[str]]:
     """Parse arguments, splitting on -- for jj fix args."""
     args = sys.argv[1:]
-    if "--" in args:
-        idx = args.index("--")
-        return args[:idx], args[idx + 1 :]
+    for idx, arg in enumerate(args):
+        if arg == "--":
+            return args[:idx], args[idx + 1 :]
     return args, []
 
 
-def main() -> int:
+def run_jmt() -> int:
     jmt_args, jj_args = parse_args()
-    print_only = "--print" in jmt_args
-    sync_only = "--sync" in jmt_args
-    list_only = "--list" in jmt_args
+    print_only = False
+    sync_only = False
+    list_only = False
     only_tools: set[str] | None = None
 
-    # Parse --only option
-    for arg in jmt_args:
-        if arg.startswith("--only="):
+    for idx, arg in enumerate(jmt_args):
+        if arg == "--print":
+            print_only = True
+        elif arg == "--sync":
+            sync_only = True
+        elif arg == "--list":
+            list_only = True
+        elif arg.startswith("--only="):
             only_tools = set(arg[7:].split(","))
-        elif arg == "--only":
-            idx = jmt_args.index(arg)
-            if idx + 1 < len(jmt_args):
-                only_tools = set(jmt_args[idx + 1].split(","))
+        elif arg == "--only" and idx + 1 < len(jmt_args):
+            only_tools = set(jmt_args[idx + 1].split(","))
 
     flake_root = find_flake_root()
     if not flake_root:
-        print("Not in a flake directory", file=sys.stderr)
+        log("Not in a flake directory")
         return 1
 
     debug(f"Flake root: {flake_root}")
@@ -469,12 +576,12 @@ def main() -> int:
         if not build_formatter(flake_root, cache_path):
             return 1
     else:
-        print("Using cached formatter", file=sys.stderr)
+        log("Using cached formatter")
 
     # Find treefmt config
     config_path = find_treefmt_config(cache_path)
     if not config_path:
-        print("Could not find treefmt config", file=sys.stderr)
+        log("Could not find treefmt config")
         return 1
 
     debug(f"Treefmt config: {config_path}")
@@ -482,6 +589,9 @@ def main() -> int:
     # Parse and generate
     treefmt_config = parse_treefmt_config(config_path)
 
+    # Show progress messages before anything goes to stdout
+    flush_log()
+
     # List mode
     if list_only:
         list_tools(treefmt_config)
@@ -501,9 +611,16 @@ def main() -> int:
     if not sync_only:
         return run_jj_fix(flake_root, jj_args if jj_args else None)
 
-    print("Done!", file=sys.stderr)
+    log("Done!")
     return 0
 
 
+def main() -> int:
+    try:
+        return run_jmt()
+    finally:
+        flush_log()
+
+
 if __name__ == "__main__":
     sys.exit(main())